@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Startup-time benchmark: parsing a large generated program directly, versus
+# through the on-disk parse cache, and a short scripted debugcli session with a
+# cold and a warm cache.
+#   python bench_startup.py [size]
+
+import bfdebug as bf
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def genscript(size):
+  rng = random.Random(size)
+  pieces = ["+++", "--", ">>", "<", "[->+<]", ".", "[>+[-<]>]", "\n", "# a comment\n"]
+  parts = []
+  length = 0
+  while length < size:
+    piece = rng.choice(pieces)
+    parts.append(piece)
+    length += len(piece)
+  return "".join(parts) + "\n"
+
+def best(fn, repeat=5):
+  times = []
+  for i in range(repeat):
+    start = time.time()
+    fn()
+    times.append(time.time() - start)
+  return min(times)
+
+def session(scriptpath, cachedir):
+  env = dict(os.environ, BFDEBUG_CACHE=cachedir)
+  start = time.time()
+  with open(os.devnull, "r+") as devnull:
+    subprocess.check_call([sys.executable, os.path.join(here, "debugcli.py"), scriptpath],
+        stdin=devnull, stdout=devnull, env=env, cwd=tempfile.gettempdir())
+  return time.time() - start
+
+def main():
+  size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  script = genscript(size)
+  workdir = tempfile.mkdtemp(prefix="bfbench")
+  try:
+    scriptpath = os.path.join(workdir, "bench.bf")
+    with open(scriptpath, "w") as scriptfile:
+      scriptfile.write(script)
+    cachedir = os.path.join(workdir, "cache")
+
+    parsetime = best(lambda: bf.parse(script, 0, 0, None))
+    coldtime = best(lambda: (shutil.rmtree(cachedir, True), bf.parsecached(script, cachedir)))
+    warmtime = best(lambda: bf.parsecached(script, cachedir))
+    print("script: {} chars, {} commands".format(len(script), len(bf.flatten(bf.parsecached(script)))))
+    print("parse, no cache:         {:.3f}s".format(parsetime))
+    print("parse, writing cache:    {:.3f}s".format(coldtime))
+    print("load from cache:         {:.3f}s".format(warmtime))
+
+    shutil.rmtree(cachedir, True)
+    cold = session(scriptpath, cachedir)
+    warm = min(session(scriptpath, cachedir) for i in range(5))
+    print("debugcli session, cold:  {:.3f}s".format(cold))
+    print("debugcli session, warm:  {:.3f}s".format(warm))
+  finally:
+    shutil.rmtree(workdir, True)
+
+if __name__ == "__main__":
+  main()
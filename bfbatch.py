@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# Headless batch runner: runs a manifest of programs against input files in
+# parallel, without recording history, and reports the results as JSON.
+#   bfbatch.py manifest.json [-j jobs] [-o results.json]
+# The manifest is a JSON list of cases.  Paths are relative to the manifest:
+#   [{"script": "rot13.bf", "input": "rot13.in", "expected": "rot13.out", "steps": 100000}]
+# "input" and "steps" are optional; "name" defaults to the script path.
+# Failing cases come with a debugcli command line that stops just before the
+# step where they went wrong.  debugcli splits its commands on spaces, so that
+# can't work for an input file whose path contains one; the report says so.
+
+import bfdebug as bf
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import shlex
+import sys
+import time
+
+class outputmismatch(Exception):
+  pass
+
+# output stream which fails as soon as the program writes something unexpected,
+# so that the step count at that moment is the failing step
+class checkedoutput:
+  def __init__(self, expected):
+    self.expected = expected
+    self.length = 0
+  def write(self, text):
+    end = self.length + len(text)
+    if self.expected[self.length:end] != text:
+      raise outputmismatch(text)
+    self.length = end
+
+def readfile(path):
+  with open(path, "rb") as infile:
+    return infile.read().decode("latin-1")
+
+def loadmanifest(path):
+  basedir = os.path.dirname(os.path.abspath(path))
+  with open(path) as manifest:
+    cases = json.load(manifest)
+  for case in cases:
+    for key in ("script", "input", "expected"):
+      if case.get(key) is not None:
+        case[key] = os.path.join(basedir, case[key])
+    case.setdefault("name", case["script"])
+  return cases
+
+def reprocommand(case, steps):
+  args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "debugcli.py"), case["script"]]
+  if case.get("input") is not None:
+    args.append("input {}".format(case["input"]))
+  args.append("goto {}".format(steps))
+  return " ".join(shlex.quote(arg) for arg in args)
+
+def runcase(case, cachedir=None):
+  result = {"name": case["name"], "passed": False, "steps": 0}
+  start = time.time()
+  vm = None
+  try:
+    with open(case["script"]) as scriptfile:
+      script = scriptfile.read()
+    expected = readfile(case["expected"])
+    output = checkedoutput(expected)
+    if case.get("input") is not None:
+      instream = open(case["input"], "rb")
+    else:
+      instream = io.BytesIO()
+    with instream:
+      vm = bf.bfrunner(script, instream, output, cachedir)
+      try:
+        vm.runfast(case.get("steps"))
+      finally:
+        result["steps"] = vm.faststeps
+    if vm.getcmd() is not vm.endcmd:
+      result["error"] = "step limit reached"
+    elif output.length < len(expected):
+      result["error"] = "output ended after {} of {} characters".format(output.length, len(expected))
+    else:
+      result["passed"] = True
+  except outputmismatch:
+    result["error"] = "unexpected output at character {}".format(output.length)
+  except Exception as e:
+    result["error"] = "{}: {}".format(type(e).__name__, e)
+  result["seconds"] = time.time() - start
+  if not result["passed"] and vm is not None:
+    result["repro"] = reprocommand(case, result["steps"])
+    if case.get("input") is not None and " " in case["input"]:
+      result["reproproblem"] = "debugcli's input command can't take a path with spaces; copy the input file somewhere without them"
+  return result
+
+def _runcase(args):
+  return runcase(*args)
+
+def runcases(cases, jobs=None, cachedir=None):
+  pool = multiprocessing.Pool(jobs)
+  try:
+    return pool.map(_runcase, [(case, cachedir) for case in cases], chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+def main():
+  parser = argparse.ArgumentParser(description="Run a manifest of programs and check their output.")
+  parser.add_argument("manifest")
+  parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: one per core)")
+  parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+  args = parser.parse_args()
+  start = time.time()
+  results = runcases(loadmanifest(args.manifest), args.jobs, bf.defaultcachedir())
+  passed = sum(1 for result in results if result["passed"])
+  report = {
+    "passed": passed,
+    "failed": len(results) - passed,
+    "seconds": time.time() - start,
+    "cases": results,
+  }
+  text = json.dumps(report, indent=2)
+  if args.output is None:
+    print(text)
+  else:
+    with open(args.output, "w") as outfile:
+      outfile.write(text + "\n")
+  sys.exit(0 if passed == len(results) else 1)
+
+if __name__ == "__main__":
+  main()
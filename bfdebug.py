@@ -1,4 +1,10 @@
+import array
+import gc
+import hashlib
+import marshal
+import os
 import sys
+import zlib
 # base class for the eight bf instructions
 class bfcommand:
   def __init__(self, pos, parent):
@@ -37,7 +43,6 @@ class bfread(bfcommand):
 
 class bfwrite(bfcommand):
   def run(self, state, pos, instream, outstream):
-    print("char is %s: %s" % (state[pos], chr(state[pos])))
     outstream.write(chr(state[pos]))
     return bflog(self, None, None)
   def __repr__(self): return "."
@@ -64,6 +69,8 @@ class bfadder(bfcommand):
     return "{:+d}".format(self.amount)
 
 class bfcond(bfcommand):
+# position of the matching ']', which has no command of its own
+  closepos = None
   def getnext(self, state, pos):
     return self.subcmds[0] if state[pos] else self.nextcmd
   def setsubcmds(self, subcmds):
@@ -113,6 +120,8 @@ def parse(script, pos, line, outercmd):
       line = nextline
     elif bfchar == ']':
       cmd = bfcommand(bfpos(line, pos), outercmd)
+      if outercmd is not None:
+        outercmd.closepos = bfpos(line, pos)
       break
     elif bfchar in ';#' or (bfchar == '/' and script[pos+1] == '/'):
       while(script[pos] != '\n'):
@@ -128,6 +137,111 @@ def parse(script, pos, line, outercmd):
   cmds[-1].setnext(outercmd)
   return (cmds, pos, line)
 
+# Parsed programs can be cached on disk, keyed by a hash of the script, so that
+# large generated programs are only parsed once.  The cache holds a flat table
+# of commands in program order; links between them are stored as indices.
+CACHEVERSION = 2
+cmdkinds = [bfcommand, bfread, bfwrite, bfmover, bfadder, bfcond]
+
+def defaultcachedir():
+  cachedir = os.environ.get("BFDEBUG_CACHE")
+  if cachedir is None:
+    cachedir = os.path.join(os.path.expanduser("~"), ".cache", "bfdebug")
+  return cachedir
+
+# every command in program order, including those inside loops
+def flatten(cmds):
+  flat = []
+  pending = [iter(cmds)]
+  while pending:
+    for cmd in pending[-1]:
+      flat.append(cmd)
+      if isinstance(cmd, bfcond):
+        pending.append(iter(cmd.subcmds))
+        break
+    else:
+      pending.pop()
+  return flat
+
+def dumpcmds(cmds):
+  flat = flatten(cmds)
+  index = dict((id(cmd), i) for i, cmd in enumerate(flat))
+  def indexof(cmd):
+    return -1 if cmd is None else index[id(cmd)]
+  table = (
+    [cmdkinds.index(type(cmd)) for cmd in flat],
+    [cmd.pos.line for cmd in flat],
+    [cmd.pos.start for cmd in flat],
+    [cmd.pos.end for cmd in flat],
+    [getattr(cmd, "amount", 0) for cmd in flat],
+    [indexof(cmd.parent) for cmd in flat],
+    [indexof(cmd.nextcmd) for cmd in flat],
+    [cmd.closepos.line if getattr(cmd, "closepos", None) else -1 for cmd in flat],
+    [cmd.closepos.start if getattr(cmd, "closepos", None) else -1 for cmd in flat],
+  )
+  return zlib.compress(marshal.dumps((CACHEVERSION, table)), 1)
+
+def loadcmds(data):
+  version, table = marshal.loads(zlib.decompress(data))
+  if version != CACHEVERSION:
+    raise ValueError("cache version {} != {}".format(version, CACHEVERSION))
+  kinds, lines, starts, ends, amounts, parents, nexts, closelines, closestarts = table
+  flat = []
+  for kind, line, start, end, amount, closeline, closestart in zip(kinds, lines, starts, ends, amounts, closelines, closestarts):
+    cls = cmdkinds[kind]
+    if cls is bfmover or cls is bfadder:
+      cmd = cls(bfpos(line, start, end), None, amount)
+    else:
+      cmd = cls(bfpos(line, start, end), None)
+    if cls is bfcond:
+      cmd.subcmds = []
+      if closestart >= 0:
+        cmd.closepos = bfpos(closeline, closestart)
+    flat.append(cmd)
+  top = []
+  for cmd, parent, nextcmd in zip(flat, parents, nexts):
+    if nextcmd >= 0:
+      cmd.nextcmd = flat[nextcmd]
+    if parent >= 0:
+      cmd.parent = flat[parent]
+      cmd.parent.subcmds.append(cmd)
+    else:
+      top.append(cmd)
+  return top
+
+# building the command graph allocates many objects and frees none, so the
+# cyclic garbage collector is paused rather than left to rescan them repeatedly
+def parsecached(script, cachedir=None):
+  collecting = gc.isenabled()
+  gc.disable()
+  try:
+    if cachedir is None:
+      return parse(script, 0, 0, None)[0]
+    return _parsecached(script, cachedir)
+  finally:
+    if collecting:
+      gc.enable()
+
+def _parsecached(script, cachedir):
+  key = hashlib.sha1(script.encode("utf-8")).hexdigest()
+  path = os.path.join(cachedir, key + ".bfc")
+  try:
+    with open(path, "rb") as cachefile:
+      return loadcmds(cachefile.read())
+  except (IOError, OSError, ValueError, EOFError, TypeError, zlib.error):
+    pass
+  cmds = parse(script, 0, 0, None)[0]
+  try:
+    if not os.path.isdir(cachedir):
+      os.makedirs(cachedir)
+    temppath = "{}.{}.tmp".format(path, os.getpid())
+    with open(temppath, "wb") as cachefile:
+      cachefile.write(dumpcmds(cmds))
+    os.rename(temppath, path)
+  except (IOError, OSError):
+    pass
+  return cmds
+
 def runcmd(cmd, state, pos, instream, outstream):
   new = cmd.run(state, pos, instream, outstream)
   oldpos = None
@@ -140,6 +254,14 @@ def runcmd(cmd, state, pos, instream, outstream):
   log = bflog(None, oldvalue, oldpos)
   return (log, new)
 
+# output from speculatively recorded steps, tagged with the step that wrote it
+class heldoutput:
+  def __init__(self, pending):
+    self.pending = pending
+    self.step = 0
+  def write(self, text):
+    self.pending.append((self.step, text))
+
 # simple VM which can build a list of state transitions using stepend()
 # and move foward and backwards through them using step() and rstep()
 # this is a very memory-intensive way to implement reversibility, as the
@@ -147,12 +269,12 @@ def runcmd(cmd, state, pos, instream, outstream):
 # recorded are loops and reading input - the rest can be safely ignored.
 # however, it is very, very simple
 class bfrunner:
-  def __init__(self, script, instream=sys.stdin, outstream=sys.stdout):
+  def __init__(self, script, instream=sys.stdin, outstream=sys.stdout, cachedir=None):
     initcmd = bfcommand(bfpos(0, 0, 0), None)
     endpos = bfpos(script.count("\n"), len(script), len(script))
     endcmd = bfcommand(endpos, None)
     initcmd.parent = endcmd
-    self.allcmds = parse(script, 0, 0, None)[0]
+    self.allcmds = parsecached(script, cachedir)
     initcmd.setnext(self.allcmds[0])
     self.allcmds[-1].setnext(endcmd)
     self.initcmd = initcmd
@@ -162,11 +284,19 @@ class bfrunner:
     self.statepos = 0
     self.backstate = []
     self.fwdstate = []
-    self.state = [0 for x in range(16384)]
+    self.state = [0] * 16384
     self.pos = 0
     self.script = script
     self.instream = instream
     self.outstream = outstream
+    self.frontier = None
+    self.specstart = None
+    self.pendingout = []
+    self.tracer = None
+# steps dropped from the front of the recording, so trimmed + statepos counts
+# from the start of the program, and the cells the pointer visited in them
+    self.trimmed = 0
+    self.trimmedcells = None
   def resetfuture(self, fwdlen = 0):
 # won't reset position in input streams, so be careful
     if fwdlen < 0:
@@ -182,26 +312,146 @@ class bfrunner:
     self.backstate = self.backstate[:length]
     self.fwdstate = self.fwdstate[:length]
     self.newcmd = cmd
+    self.frontier = None
+    self.pendingout = [x for x in self.pendingout if x[0] < length]
+    if self.specstart is not None and self.specstart >= length:
+      self.specstart = None
   def resetpast(self, backlen = 0):
     if backlen < 0:
       raise ValueError
     start = max(self.statepos - backlen, 0)
+    cells = [log.pos for log in self.fwdstate[:start] if log.pos is not None]
+    if self.trimmedcells is not None:
+      cells.extend(self.trimmedcells)
+    if cells:
+      self.trimmedcells = (min(cells), max(cells))
+    self.trimmed += start
     self.statelen = self.statelen - start
     self.statepos = self.statepos - start
     self.fwdstate = self.fwdstate[start:]
     self.backstate = self.backstate[start:]
+    self.frontier = None
+    self.pendingout = [(index - start, text) for index, text in self.pendingout]
+    if self.specstart is not None:
+      self.specstart = max(self.specstart - start, 0)
+
+# Record up to 'count' steps past the end of the recording without moving the
+# current position, staying at most 'ahead' steps in front of it, so that
+# stepping forward later is a replay.  Steps run against a copy of the tape as
+# it is at the end of the recording (the frontier), leaving the current state
+# alone.  Output is held back until replay reaches the step that wrote it, and
+# speculation stops at any ',' since input read early couldn't be put back.
+# Returns the number of steps recorded.
+  def prerecord(self, count, ahead):
+    count = min(count, self.statepos + ahead - self.statelen)
+    if count <= 0 or self.newcmd is self.endcmd or isinstance(self.newcmd, bfread) or self.tracer is not None:
+      return 0
+    if self.frontier is None or self.frontier[2] != self.statelen:
+      tape, pos = list(self.state), self.pos
+      for log in self.fwdstate[self.statepos:self.statelen]:
+        if log.pos is not None: pos = log.pos
+        if log.value is not None: tape[pos] = log.value
+      self.frontier = [tape, pos, self.statelen]
+    if self.specstart is None:
+      self.specstart = self.statelen
+    tape, pos = self.frontier[0], self.frontier[1]
+    held = heldoutput(self.pendingout)
+    cmd = self.newcmd
+    recorded = 0
+    try:
+      while recorded < count and cmd is not self.endcmd and not isinstance(cmd, bfread):
+        held.step = self.statelen
+        oldstate, newstate = runcmd(cmd, tape, pos, self.instream, held)
+        if newstate.pos is not None: pos = newstate.pos
+        if newstate.value is not None: tape[pos] = newstate.value
+        nextcmd = cmd.getnext(tape, pos)
+        self.backstate.append(oldstate)
+        self.fwdstate.append(newstate)
+        self.statelen += 1
+        self.newcmd = cmd = nextcmd
+        recorded += 1
+    except Exception:
+# the live run will hit this error for real; a half-applied step may have
+# left the frontier inconsistent, so rebuild it next time
+      self.frontier = None
+      raise
+    self.frontier = [tape, pos, self.statelen]
+    return recorded
+
+# throw away speculated steps the user hasn't reached, e.g. after the state
+# has been changed by hand and they may no longer be what would happen.
+# specstart follows replay forward, so steps the user has already been
+# through, and whose output has been shown, are kept
+  def discardspeculation(self):
+    if self.specstart is not None:
+      self.resetfuture(max(self.specstart - self.statepos, 0))
+      self.specstart = None
+
+  def flushoutput(self):
+    while self.pendingout and self.pendingout[0][0] < self.statepos:
+      self.outstream.write(self.pendingout.pop(0)[1])
 
   def stepend(self):
     if self.newcmd is self.endcmd:
       raise StopIteration
     else:
       oldstate, newstate = runcmd(self.newcmd, self.state, self.pos, self.instream, self.outstream)
+      self.specstart = None
       self.backstate.append(oldstate)
       self.fwdstate.append(newstate)
       self.applystate(newstate)
       self.newcmd = self.newcmd.getnext(self.state, self.pos)
       self.statelen += 1
       self.statepos += 1
+
+# Stream every step executed from here on to 'tracer', keeping only the last
+# 'window' steps of history so that a long traced run doesn't fill memory.
+# Steps are traced when they're first executed, so speculation is discarded
+# and stays off while tracing: steps recorded ahead never pass through here.
+# The traced stepend is swapped in on the instance, so stepend costs nothing
+# extra while tracing is off.
+  def starttrace(self, tracer, window=65536):
+    self.discardspeculation()
+    self.tracer = tracer
+    self.tracewindow = window
+    self.stepend = self._tracedstepend
+  def stoptrace(self):
+    tracer = self.tracer
+    if tracer is not None:
+      del self.stepend
+      self.tracer = None
+    return tracer
+  def _tracedstepend(self):
+    bfrunner.stepend(self)
+    new = self.state[self.pos]
+    old = self.backstate[-1].value
+    self.tracer.record(self.fwdstate[-1].cmd, self.pos, new if old is None else old, new)
+    if self.statepos > 2 * self.tracewindow:
+      self.resetpast(self.tracewindow)
+# run without recording, for when only the outcome matters.  history can't
+# survive a gap in the recording, so any that exists is discarded first.
+# returns the number of steps taken, which stops at 'limit' if one is given;
+# if a command raises, the steps completed before it are left in faststeps
+  def runfast(self, limit=None):
+    self.resetfuture()
+    self.resetpast()
+    cmd, state, pos = self.newcmd, self.state, self.pos
+    instream, outstream, endcmd = self.instream, self.outstream, self.endcmd
+    steps = 0
+    try:
+      while cmd is not endcmd and steps != limit:
+        new = cmd.run(state, pos, instream, outstream)
+        if new.pos is not None: pos = new.pos
+        if new.value is not None: state[pos] = new.value
+        cmd = cmd.getnext(state, pos)
+        steps += 1
+    finally:
+      self.newcmd = cmd
+      self.pos = pos
+      self.faststeps = steps
+      self.trimmed += steps
+    return steps
+
   def step(self):
     oldcmd = self.getcmd()
     if self.statepos >= self.statelen:
@@ -209,6 +459,10 @@ class bfrunner:
     else:
       self.applystate(self.fwdstate[self.statepos])
       self.statepos += 1
+      if self.specstart is not None and self.specstart < self.statepos:
+        self.specstart = self.statepos
+      if self.pendingout and self.pendingout[0][0] < self.statepos:
+        self.flushoutput()
     return oldcmd
   def rstep(self):
     if (self.statepos > 0):
@@ -217,13 +471,56 @@ class bfrunner:
       raise StopIteration
     self.applystate(state)
     self.statepos -= 1
+# move straight to 'target' within the recording, applying each step's change
+# without the per-step bookkeeping of step() and rstep()
+  def seek(self, target):
+    if not 0 <= target <= self.statelen:
+      raise ValueError(target)
+    state, pos = self.state, self.pos
+    if target > self.statepos:
+      logs = self.fwdstate[self.statepos:target]
+    else:
+      logs = self.backstate[target:self.statepos]
+      logs.reverse()
+    for log in logs:
+      if log.pos is not None: pos = log.pos
+      if log.value is not None: state[pos] = log.value
+    self.pos = pos
+    self.statepos = target
+    if self.specstart is not None and self.specstart < target:
+      self.specstart = target
+    if self.pendingout and self.pendingout[0][0] < self.statepos:
+      self.flushoutput()
   def applystate(self, newstate):
     if newstate.pos is not None: self.pos = newstate.pos
     if newstate.value is not None: self.state[self.pos] = newstate.value
   def getcmd(self):
-    if self.statepos >= self.statelen:
+    return self.cmdat(self.statepos)
+  def cmdat(self, statepos):
+    if statepos >= self.statelen:
       return self.newcmd
-    return self.fwdstate[self.statepos].cmd
+    return self.fwdstate[statepos].cmd
+
+# hash of a tape as a weighted sum of its cells modulo a Mersenne prime, so that
+# the single-cell change made by a step can be folded in with one multiply.
+# weights come from a fixed seed, so hashes of different runners are comparable
+HASHPRIME = (1 << 61) - 1
+_hashweights = []
+
+def hashweights(length):
+  global _hashweights
+  if len(_hashweights) < length:
+    import random
+    rng = random.Random(0x6266)
+    _hashweights = [rng.randrange(1, HASHPRIME) for x in range(max(length, 16384))]
+  return _hashweights
+
+class bfhash:
+  def __init__(self, cells):
+    self.weights = hashweights(len(cells))
+    self.value = sum(w * c for w, c in zip(self.weights, cells)) % HASHPRIME
+  def update(self, pos, old, new):
+    self.value = (self.value + (new - old) * self.weights[pos]) % HASHPRIME
 
 def scriptformat(vm):
   return " ".join(map(str, vm.allcmds))
@@ -347,3 +644,77 @@ def listmem(vm, width, rows, pos, watches, color = True):
         sys.stdout.write(" ")
       sys.stdout.write("\n")
   return pos + 1 < len(vm.state)
+
+# Tape searches.  The tape is a plain list, so each search converts it once to
+# a bytes object and lets bytes.find/translate/count do the scanning in C.
+# Cells that have wandered outside 0-255 make that impossible; those tapes are
+# packed as machine ints for sequence searches, and use numpy (if available)
+# or a plain loop for range searches.  Cells too big even for machine ints
+# leave the sequence search to a plain loop too.
+def tapebuffer(cells):
+  try:
+    return bytes(bytearray(cells)), 1
+  except ValueError:
+    pass
+  try:
+    packed = array.array("i", cells)
+  except OverflowError:
+    return None, None
+  return packed.tobytes(), packed.itemsize
+
+def _findpacked(buf, itemsize, pattern, start, limit):
+  found = []
+  offset = buf.find(pattern, start * itemsize)
+  while offset != -1 and len(found) < limit:
+    if offset % itemsize == 0:
+      found.append(offset // itemsize)
+    offset = buf.find(pattern, offset + 1)
+  return found
+
+# positions at or after 'start' where the sequence 'values' begins
+def findvalues(cells, values, start=0, limit=64):
+  buf, itemsize = tapebuffer(cells)
+  if buf is None:
+    return _findlist(cells, list(values), start, limit)
+  try:
+    if itemsize == 1:
+      pattern = bytes(bytearray(values))
+    else:
+      pattern = array.array("i", values).tobytes()
+  except (ValueError, OverflowError):
+    return []
+  return _findpacked(buf, itemsize, pattern, start, limit)
+
+def _findlist(cells, values, start, limit):
+  found = []
+  width = len(values)
+  for index in range(start, len(cells) - width + 1):
+    if cells[index:index+width] == values:
+      found.append(index)
+      if len(found) >= limit: break
+  return found
+
+# positions at or after 'start' holding a value between lo and hi inclusive
+def findrange(cells, lo, hi, start=0, limit=64):
+  buf, itemsize = tapebuffer(cells)
+  if itemsize == 1:
+    table = bytes(bytearray(1 if lo <= x <= hi else 0 for x in range(256)))
+    return _findpacked(buf.translate(table), 1, b"\x01", start, limit)
+# numpy is only worth its import time for this rare case
+  try:
+    import numpy
+  except ImportError:
+    numpy = None
+  if numpy is not None:
+    tape = numpy.array(cells[start:])
+    hits = numpy.flatnonzero((tape >= lo) & (tape <= hi))[:limit]
+    return [int(x) + start for x in hits]
+  found = []
+  for index in range(start, len(cells)):
+    if lo <= cells[index] <= hi:
+      found.append(index)
+      if len(found) >= limit: break
+  return found
+
+def countnonzero(cells):
+  return len(cells) - cells.count(0)
@@ -1,14 +1,14 @@
 #!/usr/bin/env python
 
-from debugger import debughandler 
+from debugger import debughandler, firstdivergence, rangestr
 import bfdebug as bf
-import traceback
-import code
-import textwrap
+import io
 import re
-import readline
-import rlcompleter
 import sys
+import threading
+
+# traceback, textwrap, code, readline and rlcompleter are imported where they're
+# used, since most sessions never need some of them and they all add to startup
 
 if sys.version_info.major == 2:
   input = raw_input
@@ -28,18 +28,21 @@ pg13 = True
 languagename = "brainf***" if pg13 else "brainfuck"
 
 def readline_gethist():
+  import readline
   print(readline.get_line_buffer())
   itemrange = range(1,readline.get_current_history_length()+1)
   histlist = [readline.get_history_item(x) for x in itemrange]
   return histlist
 
 def readline_sethist(hist):
+  import readline
   readline.clear_history()
   for item in hist:
     readline.add_history(item)
 
 # wrap a string, preserving indentation -- used for help messages
 def messageformat(message):
+    import textwrap
     lines = textwrap.dedent(message).lstrip().splitlines()
     wrapper = textwrap.TextWrapper()
     def indent(line):
@@ -62,14 +65,20 @@ class debugdict:
     return list(self.commands.keys())
 
 
-class debugrepl(code.InteractiveConsole, object):
+class debugrepl:
 # with thanks to Abu Ashraf Masnum
 # http://www.masnun.com/2014/01/09/embed-a-python-repl-in-your-program.html
-  def __init__(self, *args, **kwargs):
+# the console is only built the first time the repl is entered
+  def __init__(self, mylocals):
     self.firstrun = True
-    code.InteractiveConsole.__init__(self, *args, **kwargs)
+    self.locals = mylocals
+    self.console = None
 
   def interact(self):
+    if self.console is None:
+      import code
+      self.console = code.InteractiveConsole(self.locals)
+      self.console.raw_input = self.raw_input
     if self.firstrun:
       banner = messageformat("""
       Entering Python repl:
@@ -85,19 +94,64 @@ class debugrepl(code.InteractiveConsole, object):
       self.firstrun = False
     else:
       banner = "Re-entering Python repl"
-    code.InteractiveConsole.interact(self, banner)
-    
+    self.console.interact(banner)
+
   def raw_input(self, prompt=""):
     return input("repl>")
+
+# Records ahead of the cursor in a background thread while the prompt is idle,
+# so that forward stepping commands become replays.  The main thread holds the
+# lock for the whole of each command, so the vm is only touched by one thread
+# at a time, and waits at most one chunk for the speculator to let go.
+class speculator:
+  def __init__(self, cli, ahead=20000, chunk=500):
+    self.cli = cli
+    self.ahead = ahead
+    self.chunk = chunk
+    self.enabled = True
+    self.lock = threading.Lock()
+    self.idle = threading.Event()
+
+  def start(self):
+    thread = threading.Thread(target=self.loop)
+    thread.daemon = True
+    thread.start()
+
+  def loop(self):
+    while True:
+      self.idle.wait()
+      with self.lock:
+        if not self.idle.is_set():
+          continue
+        try:
+          recorded = self.cli.vm.prerecord(self.chunk, self.ahead)
+        except Exception:
+          recorded = 0
+        if recorded == 0:
+          self.idle.clear()
+
+  def pause(self):
+    self.idle.clear()
+    self.lock.acquire()
+
+  def resume(self):
+    if self.enabled:
+      self.idle.set()
+    self.lock.release()
+
 class debugcli:
 
-  def __init__(self, scriptfile):
-    self.debugger = debughandler(scriptfile)
+  def __init__(self, scriptfile, cachedir=None):
+    self.cachedir = cachedir
+    self.debugger = debughandler(scriptfile, cachedir)
     self.vm = self.debugger.vm
     self.initcommands()
     self.initrepl()
     self.clearlastcmd()
     self.colorize = True
+    self.speculator = speculator(self)
+    self.traceatexit = False
+    self.consolestdout = None
 
   def initcommands(self):
     self.commands = {
@@ -121,12 +175,20 @@ class debugcli:
       "watches": self.printAllWatches,
       "nextline": self.nextline,
       "prevline": self.prevline,
+      "stats": self.stats,
+      "find": self.find,
+      "count": self.count,
+      "diffrun": self.diffrun,
+      "goto": self.goto,
+      "speculate": self.speculate,
+      "trace": self.trace,
+      "hang": self.hang,
     }
     def addstepper(name):
-# this can't be done in a loop, or each lambda will be bound to the same 'method' variable
-      method = getattr(self.debugger, name)
-      self.commands[name] = lambda *ignore: self._dostepper(method, True)
-      self.commands["r"+name] = lambda *ignore: self._dostepper(method, False)
+# this can't be done in a loop, or each lambda will be bound to the same 'name' variable
+# the method is looked up on each call, since diffrun can replace the debugger
+      self.commands[name] = lambda *ignore: self._dostepper(getattr(self.debugger, name), True)
+      self.commands["r"+name] = lambda *ignore: self._dostepper(getattr(self.debugger, name), False)
     for i in ["step","over","over2","out"]: addstepper(i)
 
   def cmd(self):
@@ -156,13 +218,45 @@ class debugcli:
       offsetstr = ''
     else:
       offsetstr, pos = self.parseoffset(initpos)
-    unfinished = bf.listmem(vm, width, rows, pos, self.debugger.watches.keys(), self.colorize)
+    unfinished = bf.listmem(vm, width, rows, pos, self.debugger.watches, self.colorize)
     if unfinished:
       nextoffset = offsetstr + str(pos + width * rows)
       self.setlastcmd(self.listmem, widthstr, rowsstr, offsetstr + nextoffset)
     else:
       self.clearlastcmd()
 
+  def find(self, *args):
+    if not args:
+      print("find what?")
+    elif args[0] == "range":
+      lo, hi = int(args[1], 0), int(args[2], 0)
+      self._find(lambda start: bf.findrange(self.vm.state, lo, hi, start), 0)
+    else:
+      if args[0].startswith('"'):
+        values = [ord(c) for c in " ".join(args).strip('"')]
+      else:
+        values = [int(x, 0) for x in args]
+      self._find(lambda start: bf.findvalues(self.vm.state, values, start), 0)
+
+# print a page of matches as absolute positions and offsets from the pointer,
+# either of which can be passed to mem or addwatch
+  def _find(self, search, start):
+    found = search(start)
+    if not found:
+      print("no matches" if start == 0 else "no more matches")
+      self.clearlastcmd()
+      return
+    for pos in found:
+      print("{: 6d}  ({:+d})".format(pos, pos - self.vm.pos))
+    self.setlastcmd(self._find, search, found[-1] + 1)
+
+  def count(self, what, *ignore):
+    if what == "nonzero":
+      print(bf.countnonzero(self.vm.state))
+    else:
+      print(self.vm.state.count(int(what, 0)))
+    self.clearlastcmd()
+
   def listsource(self, linestr = None, linecountstr = '10', *ignore):
     line = None if linestr is None else int(linestr)
     linecount = int(linecountstr)
@@ -177,27 +271,35 @@ class debugcli:
     else:
       self.clearlastcmd()
 
-  def printWatch(self, pos, minsize = 0):
-    formatstr = "{{: <{}}}  {{:04d}}  ".format(minsize)
+  def printWatch(self, watch, minsize = 0, rangesize = 0):
+    lo, hi, name = watch
+    formatstr = "{{: <{}}}  {{: <{}}}  ".format(minsize, rangesize)
     vm = self.vm
     statepos = self.vm.statepos
-    if vm.pos == pos and vm.fwdstate and vm.fwdstate[statepos-1].value is not None:
+    if lo <= vm.pos <= hi and vm.fwdstate and vm.fwdstate[statepos-1].value is not None:
       valuestr = "{:02x} -> {:02x}".format(
           vm.backstate[statepos-1].value,
           vm.fwdstate[statepos-1].value
       )
+      if lo != hi:
+        valuestr = "[{}] {}".format(vm.pos, valuestr)
+    elif lo == hi:
+      valuestr = "{}".format(vm.state[lo])
     else:
-      valuestr = "{}".format(vm.state[vm.pos])
-    namestr = formatstr.format(self.debugger.watches[pos], pos)
+      cells = vm.state[lo:min(hi + 1, lo + 8)]
+      valuestr = " ".join("{:02x}".format(x) for x in cells)
+      if hi - lo >= 8: valuestr += " ..."
+    namestr = formatstr.format(name, rangestr(lo, hi))
     print(namestr + valuestr)
 
   def printAllWatches(self, *ignore):
     if len(self.debugger.watches) == 0:
       print("No watches")
     else:
-      minsize = max([len(x) for x in self.debugger.watches.values()])
-      for key in sorted(self.debugger.watches.keys()):
-        self.printWatch(key, minsize)
+      minsize = max([len(name) for lo, hi, name in self.debugger.watches])
+      rangesize = max([len(rangestr(lo, hi)) for lo, hi, name in self.debugger.watches])
+      for watch in self.debugger.watches:
+        self.printWatch(watch, minsize, rangesize)
 
   def _dostepper(self, stepper, forward):
     self.setlastcmd(self._dostepper, stepper, forward)
@@ -218,7 +320,22 @@ class debugcli:
       print("reached breakpoint at line {}".format(self.vm.getcmd().pos.line))
     if self.debugger.isWatchpoint():
       print("reached watchpoint at memory position {}".format(self.vm.pos))
-      self.printWatch(self.vm.pos)
+      self.printWatch(self.debugger.watches.find(self.vm.pos))
+    hang = self.debugger.lasthang
+    if hang is not None:
+      print("infinite loop: the state at step {} repeats every {} steps".format(hang["since"], hang["period"]))
+      print("  in the loop from line {} column {} to line {} column {}".format(
+          hang["line"], hang["column"], hang["endline"], hang["endcolumn"]))
+
+  def goto(self, stepstr, *ignore):
+    target = int(stepstr)
+    if target < self.vm.trimmed:
+      print("steps before {} are no longer recorded".format(self.vm.trimmed))
+    elif self.debugger.goto(target):
+      self.cmd()
+    else:
+      print("done!")
+    self.clearlastcmd()
 
   def nextline(self, *ignore):
     self._dostepper(self.debugger.nextline, True)
@@ -230,6 +347,72 @@ class debugcli:
       print("{: 2d}  {}".format(i, l))
     self.clearlastcmd()
 
+  def stats(self, *ignore):
+    stats = self.debugger.stats()
+    rate = stats["stepspersec"]
+    print("recorded steps:  {}".format(stats["steps"]))
+    print("total steps:     {}".format(stats["totalsteps"]))
+    print("trace memory:    ~{:.1f} KiB".format(stats["tracebytes"] / 1024.0))
+    print("touched cells:   {} to {}".format(stats["lowcell"], stats["highcell"]))
+    print("last command:    {} steps{}".format(stats["laststeps"],
+        "" if rate is None else ", {:.0f} steps/sec".format(rate)))
+    print("live steps:      {}".format(stats["livesteps"]))
+    print("replayed steps:  {}".format(stats["replaysteps"]))
+    self.clearlastcmd()
+
+  def diffrun(self, inputa, inputb, limitstr=None, *ignore):
+    limit = 1000000 if limitstr is None else int(limitstr)
+    runs = []
+    for filename in (inputa, inputb):
+      run = debughandler(self.vm.script, self.cachedir)
+      run.setinput(filename)
+      run.vm.outstream = io.StringIO()
+      runs.append(run)
+    steps = firstdivergence(*runs, limit=limit)
+    if steps is None:
+      if runs[0].vm.statepos == limit:
+        print("no divergence in the first {} steps".format(limit))
+        return
+      ending = "finished" if runs[0].vm.getcmd() is runs[0].vm.endcmd else "stopped"
+      print("no divergence: both runs {} in the same state after {} steps".format(ending, runs[0].vm.statepos))
+      return
+    a, b = runs
+    cmda, cmdb = a.vm.getcmd(), b.vm.getcmd()
+    print("runs diverge after {} steps, at line {}".format(steps, cmdb.pos.line))
+    if cmda.pos.start != cmdb.pos.start:
+      print("control flow differs: {} runs {}, {} runs {}".format(inputa, cmda, inputb, cmdb))
+    else:
+      for filename, run in zip((inputa, inputb), runs):
+        try:
+          run.safe_step()
+        except Exception as e:
+          if isinstance(cmdb, bf.bfread):
+            print("{}: fails reading input at step {}: {}".format(filename, steps, e))
+          else:
+            print("{}: fails at step {}: {}".format(filename, steps, e))
+          continue
+        if isinstance(cmdb, bf.bfread):
+          print("{}: reads {!r}".format(filename, chr(run.vm.state[run.vm.pos])))
+        else:
+          print("{}: pointer {}, value {}".format(filename, run.vm.pos, run.vm.state[run.vm.pos]))
+        run.safe_rstep()
+    print("now debugging the run with input from {}".format(inputb))
+    self.stoptrace()
+    b.breaklines = self.debugger.breaklines
+    b.watches = self.debugger.watches
+    b.hangcheck = self.debugger.hangcheck
+    b.vm.outstream = self.vm.outstream
+    self.setdebugger(b)
+    self.clearlastcmd()
+
+  def setdebugger(self, debugger):
+# a trace follows one run, so it ends when the run being debugged changes
+    self.stoptrace()
+    self.debugger = debugger
+    self.vm = debugger.vm
+    self.repllocals["debug"] = debugger
+    self.repllocals["vm"] = self.vm
+
   def addbrk(self, linestr, *ignore):
     ok, errmsg = self.debugger.addbrk(int(linestr))
     if not ok: print(errmsg)
@@ -241,11 +424,17 @@ class debugcli:
     self.clearlastcmd()
 
   def addwatch(self, name, pos=None, *ignore):
+    hi = None
     if pos is None:
       pos = self.vm.pos
     else:
-      pos = self.parseoffset(pos)[1]
-    ok, errmsg = self.debugger.addwatch(name, pos)
+      bounds = re.match(r"^([+-]?\d+)-([+-]?\d+)$", pos)
+      if bounds:
+        pos = self.parseoffset(bounds.group(1))[1]
+        hi = self.parseoffset(bounds.group(2))[1]
+      else:
+        pos = self.parseoffset(pos)[1]
+    ok, errmsg = self.debugger.addwatch(name, pos, hi)
     if not ok: print(errmsg)
 
   def delwatch(self, namepos, *ignore):
@@ -262,6 +451,74 @@ class debugcli:
       self.commands[target](*newargs)
     self.commands[name] = alias
 
+  def speculate(self, setting=None, aheadstr=None, *ignore):
+    if setting is None:
+      print("speculation is {}, up to {} steps ahead".format(
+          "on" if self.speculator.enabled else "off", self.speculator.ahead))
+    else:
+      self.speculator.enabled = setting.lower() in ["on", "true", "1", "yes"]
+      if aheadstr is not None:
+        self.speculator.ahead = int(aheadstr)
+      if not self.speculator.enabled:
+        self.vm.discardspeculation()
+    self.clearlastcmd()
+
+  def trace(self, target=None, windowstr=None, *ignore):
+    if target is None:
+      tracer = self.vm.tracer
+      if tracer is None:
+        print("tracing is off")
+      else:
+        print("tracing to {}, next record is step {}".format(self.tracetarget, tracer.step))
+    elif target.lower() == "off":
+      self.stoptrace()
+    else:
+      import tracefile
+      self.stoptrace()
+      if target == "-":
+        stream = sys.stdout.buffer
+        self.redirectconsole()
+      else:
+        stream = open(target, "wb")
+      self.vm.discardspeculation()
+      window = 65536 if windowstr is None else int(windowstr)
+      self.vm.starttrace(tracefile.tracewriter(stream, self.vm, closestream=target != "-"), window)
+      self.tracetarget = target
+      if not self.traceatexit:
+        import atexit
+        atexit.register(self.stoptrace)
+        self.traceatexit = True
+    self.clearlastcmd()
+
+  def stoptrace(self):
+    tracer = self.vm.stoptrace()
+    if tracer is not None:
+      tracer.close()
+    self.restoreconsole()
+
+# while a trace goes to stdout, the console's own text and the program's output
+# go to stderr, so that stdout holds nothing but the trace
+  def redirectconsole(self):
+    sys.stdout.flush()
+    self.consolestdout = sys.stdout
+    self.consoleoutstream = self.vm.outstream
+    if self.vm.outstream is sys.stdout:
+      self.vm.outstream = sys.stderr
+    sys.stdout = sys.stderr
+
+  def restoreconsole(self):
+    if self.consolestdout is not None:
+      sys.stdout.flush()
+      sys.stdout = self.consolestdout
+      self.vm.outstream = self.consoleoutstream
+      self.consolestdout = None
+
+  def hang(self, setting=None, *ignore):
+    if setting is not None:
+      self.debugger.sethangcheck(setting.lower() in ["on", "true", "1", "yes"])
+    print("infinite loop detection is " + ("on" if self.debugger.hangcheck is not None else "off"))
+    self.clearlastcmd()
+
   def setcolor(self, color=None, *ignore):
     if color is None:
       print("color is " + ("on" if self.colorize is True else "off"))
@@ -274,11 +531,16 @@ class debugcli:
     mylocals["cli"] = commands
     mylocals["debug"] = self.debugger
     mylocals["vm"] = self.vm
+    self.repllocals = mylocals
     self.repl = debugrepl(mylocals)
     self.replhist = []
-    self.replcompleter = rlcompleter.Completer(mylocals).complete
+    self.replcompleter = None
 
   def dorepl(self, *ignore):
+    import readline
+    if self.replcompleter is None:
+      import rlcompleter
+      self.replcompleter = rlcompleter.Completer(self.repllocals).complete
     cmdhist = readline_gethist()
     completer = readline.get_completer()
     readline_sethist(self.replhist)
@@ -290,6 +552,8 @@ class debugcli:
     readline.set_completer(completer)
     readline_sethist(cmdhist)
 
+# the state may have been changed by hand, so speculated steps can't be trusted
+    self.vm.discardspeculation()
     self.clearlastcmd()
 
   def noop(self, *ignore): pass
@@ -327,6 +591,8 @@ class debugcli:
         Step over the next instruction, stopping at completion of all passes through a loop.
       nextline
         Execute code until the next line.
+      goto step
+        Move forwards or backwards until exactly 'step' commands have been executed since the start of the program.
       run
         Continue executing until a breakpoint or the end of the program.  Note that run and rrun are currently the only commands to take note of breakpoints and watchpoints.
       rover, rover2, prevline, rout, rrun:
@@ -336,17 +602,31 @@ class debugcli:
       delbrk line
         Remove the breakpoint from 'line'.
       input filename
-        Provide input to the vm from the given file, rather than stdin.
+        Provide input to the vm from the given file, rather than stdin.  Commands are split on spaces, so the filename can't contain any.
+      diffrun inputA inputB [steps]
+        Run the program twice, with input from each file, and find the first step at which the two runs differ, giving up after 'steps' steps (default 1000000).  Debugging then continues in the run using inputB, positioned just before that step.
       alias command [args]
         Add an alias for a command.  It will be executed with the commands provided to the alias as well as any you subsequently provide.
-      addwatch name [pos]
-        Watch a memory location and break on changes.  Defaults to the pointer's current address.
+      addwatch name [pos|lo-hi]
+        Watch a memory location, or every location from lo to hi inclusive, and break on changes.  Defaults to the pointer's current address.  Positions may be offsets from the pointer, as for mem.
       delwatch name|pos
-        Remove a watch.
+        Remove a watch, by name or by any position it covers.
       watches
         List all watches and their current values.
+      find value [value...] | find "text | find range lo hi
+        Search memory for a value, a sequence of values, a string, or any value between lo and hi.  Positions are shown both absolutely and relative to the pointer, ready for mem and addwatch.  Press enter to show more matches.
+      count nonzero|value
+        Count the cells which are nonzero or hold 'value'.
+      stats
+        Show the number of recorded steps and of steps since the start of the program, an estimate of their memory use, the lowest and highest cells the pointer has visited, the speed of the last stepping command, and how many steps were recorded live versus replayed from history.
+      speculate [on|off] [steps]
+        While waiting at the prompt, record up to 'steps' (default 20000) steps ahead in the background, so that stepping forward is instant.  Speculation stops at any input command, and its output is only shown once you step past it.  On by default.
+      hang [on|off]
+        While running forward, stop if the program provably loops forever: the tape, pointer and current command exactly repeat with no input read in between.  Shows the loop's source span and the period in steps.  Repeats are confirmed from the recorded history, so while tracing, loops with a period longer than the trace window go unnoticed.  Off by default.
+      trace path|- [window] | trace off
+        Write every step executed from now on to a file, or to stdout with -, as fixed-width binary records numbered from the start of the program, as for goto; while tracing to stdout, everything else that would be printed there goes to stderr.  See tracefile.py for the format and a reader.  Only the last 'window' steps (default 65536) are kept in memory while tracing, and speculation is paused.  With no arguments, shows whether tracing is on.
       repl
-        Enter a Python repl.
+        Enter a Python repl.  Speculated steps you haven't reached are discarded on return, in case the state was changed.
       color on|off
         Switch commands from colorized (default) to uncolored output.
       help
@@ -377,6 +657,7 @@ def handle(debug, input):
       if result is not None:
         print(result)
     except Exception as e:
+      import traceback
       print("error processing command:")
       traceback.print_exc()
 
@@ -386,6 +667,15 @@ def getcompleter(cli):
     return list(filter(lambda a: a.startswith(text), cli.commands.keys()))
   return clicompleter
 
+# the prompt only goes to stdout when that's a terminal, since redirected stdout
+# is for output, and with 'trace -' must start with the trace
+def prompt(text):
+  if sys.stdout.isatty():
+    return input(text)
+  sys.stderr.write(text)
+  sys.stderr.flush()
+  return input()
+
 def main():
   rccmds = []
   try:
@@ -393,18 +683,26 @@ def main():
       rccmds = rcfile.read().splitlines()
   except IOError: pass
   with open(sys.argv[1]) as infile:
-    debug = debugcli(infile.read())
-  for cmd in rccmds:
+    debug = debugcli(infile.read(), bf.defaultcachedir())
+# commands given after the script name run after .bfrc, e.g. to reproduce a
+# failing batch case with: debugcli.py script.bf "input case.in" "goto 1234"
+  for cmd in rccmds + sys.argv[2:]:
     handle(debug, cmd)
-  readline.set_completer(getcompleter(debug))
-  readline.parse_and_bind("tab: complete")
+  if sys.stdin.isatty():
+    import readline
+    readline.set_completer(getcompleter(debug))
+    readline.parse_and_bind("tab: complete")
+  debug.speculator.pause()
+  debug.speculator.start()
   while True:
+    debug.speculator.resume()
     try:
-      command = input("> ")
+      command = prompt("> ")
     except EOFError: sys.exit()
     except KeyboardInterrupt: sys.exit()
-    else:
-      handle(debug, command)
+    finally:
+      debug.speculator.pause()
+    handle(debug, command)
 
 if __name__ == "__main__":
   main()
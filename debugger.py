@@ -1,14 +1,90 @@
 import bfdebug as bf
+from flowindex import flowindex
+from hangdetect import hangdetector
+import bisect
+import sys
+import time
 
 
+# Watches cover ranges of addresses, kept sorted by their first address next to
+# a running maximum of their last, so checking whether an address is watched is
+# one binary search no matter how many ranges there are or how wide they are.
+class watchlist:
+  def __init__(self):
+    self.ranges = []
+    self.starts = []
+    self.maxends = []
+
+  def _rebuild(self):
+    self.ranges.sort()
+    self.starts = [lo for lo, hi, name in self.ranges]
+    self.maxends = []
+    end = None
+    for lo, hi, name in self.ranges:
+      end = hi if end is None else max(end, hi)
+      self.maxends.append(end)
+
+  def add(self, name, lo, hi):
+    self.ranges.append((lo, hi, name))
+    self._rebuild()
+
+  def remove(self, watch):
+    self.ranges.remove(watch)
+    self._rebuild()
+
+  def find(self, pos):
+    index = bisect.bisect_right(self.starts, pos) - 1
+    while index >= 0 and self.maxends[index] >= pos:
+      if self.ranges[index][1] >= pos:
+        return self.ranges[index]
+      index -= 1
+    return None
+
+  def byrange(self, lo, hi):
+    for watch in self.ranges:
+      if watch[0] == lo and watch[1] == hi:
+        return watch
+    return None
+
+  def byname(self, name):
+    for watch in self.ranges:
+      if watch[2] == name:
+        return watch
+    return None
+
+  def __contains__(self, pos):
+    index = bisect.bisect_right(self.starts, pos) - 1
+    return index >= 0 and self.maxends[index] >= pos
+
+  def __len__(self):
+    return len(self.ranges)
+
+  def __iter__(self):
+    return iter(self.ranges)
+
+# raised by a stepper when the step limit given to a stepping command runs out
+class steplimit(Exception):
+  pass
+
+def rangestr(lo, hi):
+  return str(lo) if lo == hi else "{}-{}".format(lo, hi)
+
 class debughandler:
-  def __init__(self, scriptfile):
+  def __init__(self, scriptfile, cachedir=None):
     self.oldlinepos = 0
     self.linepos = 0
     self.breaklines = set()
-    self.watches = {}
-    self.vm = bf.bfrunner(scriptfile)
+    self.watches = watchlist()
+    self.vm = bf.bfrunner(scriptfile, cachedir=cachedir)
     self.loopstack = []
+    self.index = flowindex()
+    self.livesteps = 0
+    self.replaysteps = 0
+    self.lastrun = (0, 0.0)
+    self.hangcheck = None
+    self.lasthang = None
+    self.budget = None
+    self.limitreached = False
 
   def isBreakpoint(self):
     if (self.oldlinepos != self.linepos):
@@ -37,25 +113,34 @@ class debughandler:
       self.breaklines.discard(line)
       return True, None
 
-  def addwatch(self, name, pos):
-    if pos in self.watches:
-      return False, "A watch at position {} is already present as '{}'".format(pos, watches[pos])
+  def addwatch(self, name, lo, hi=None):
+    hi = lo if hi is None else hi
+    if hi < lo:
+      return False, "watch range {}-{} is backwards".format(lo, hi)
+    existing = self.watches.byrange(lo, hi)
+    if existing is not None:
+      return False, "A watch at position {} is already present as '{}'".format(rangestr(lo, hi), existing[2])
     else:
-      self.watches[pos] = name
+      self.watches.add(name, lo, hi)
       return True, None
 
   def delwatchbypos(self, pos):
-    if pos in self.watches:
-      name = self.watches.pop(pos)
-      return True, "removed " + name
+    watch = self.watches.find(pos)
+    if watch is not None:
+      self.watches.remove(watch)
+      return True, "removed " + watch[2]
     else:
-      return False, "no watch found at position {}".format(namepos)
+      return False, "no watch found at position {}".format(pos)
+
+  def sethangcheck(self, enabled):
+    self.hangcheck = hangdetector() if enabled else None
 
   def delwatchbyname(self, name):
-    for k,v in self.watches.items():
-      if v == namepos:
-        return self.delwatchbypos(k)
-    return False, "no watch found named '{}'".format(namepos)
+    watch = self.watches.byname(name)
+    if watch is not None:
+      self.watches.remove(watch)
+      return True, "removed " + name
+    return False, "no watch found named '{}'".format(name)
 
   def _dostep(self):
     self.oldlinepos = self.linepos
@@ -63,12 +148,20 @@ class debughandler:
 
     cmd = self.vm.getcmd()
     head = self.loopstack[-1] if len(self.loopstack) > 0 else None
-    if cmd == head:
+    if cmd is self.vm.initcmd:
+      self.loopstack = []
+    elif cmd == head:
       self.loopstack.pop()
     elif cmd.parent != head and cmd.parent != None:
       self.loopstack.append(cmd.parent)
 
+  def _spend(self):
+    if self.budget <= 0:
+      raise steplimit()
+    self.budget -= 1
+
   def safe_step(self):
+    if self.budget is not None: self._spend()
     try:
       self.vm.step()
       self._dostep()
@@ -77,6 +170,7 @@ class debughandler:
       return False
 
   def safe_rstep(self):
+    if self.budget is not None: self._spend()
     try:
       self.vm.rstep()
       self._dostep()
@@ -87,27 +181,200 @@ class debughandler:
   def _choosestepper(self, forward):
     return self.safe_step if forward else self.safe_rstep
 
-  def step(self, forward = True):
-    return self.safe_step() if forward else self.safe_rstep()
-  def run(self, forward = True):
-    return self._runsteps(self._choosestepper(forward))
-  def over(self, forward = True):
-    return self._runover(self._choosestepper(forward))
-  def over(self, forward = True):
-    return self._runover(self._choosestepper(forward))
-  def over2(self, forward = True):
-    return self._runover2(self._choosestepper(forward))
-  def out(self, forward = True):
-    return self._runout(self._choosestepper(forward))
-  def nextline(self, forward = True):
-    return self._runnextline(self._choosestepper(forward))
-  
+# each stepping command takes an optional limit on the number of steps it may
+# take, after which it stops where it is, as though it had hit a breakpoint
+  def step(self, forward = True, limit = None):
+    return self._timed(self._runstep, forward, limit)
+  def run(self, forward = True, limit = None):
+    return self._timed(self._runsteps, forward, limit)
+  def over(self, forward = True, limit = None):
+    return self._timed(self._runover, forward, limit)
+  def over2(self, forward = True, limit = None):
+    return self._timed(self._runover2, forward, limit)
+  def out(self, forward = True, limit = None):
+    return self._timed(self._runout, forward, limit)
+  def nextline(self, forward = True, limit = None):
+    return self._timed(self._runnextline, forward, limit)
+# 'target' counts from the start of the program, even if the front of the
+# recording has been trimmed
+  def goto(self, target, limit = None):
+    target -= self.vm.trimmed
+    forward = target >= self.vm.statepos
+    return self._timed(lambda stepper: self._rungoto(stepper, target), forward, limit)
+
+# Bookkeeping is done once per command from the change in statepos and statelen,
+# so the steps themselves stay as cheap as they were: every step that grew the
+# recording went through stepend, everything else was a replay.  Both are
+# counted from the start of the program, since tracing trims the recording
+# as it goes.
+  def _timed(self, runner, forward, limit = None):
+    vm = self.vm
+    startpos, startlen = vm.trimmed + vm.statepos, vm.trimmed + vm.statelen
+    self.lasthang = None
+    self.limitreached = False
+    self.budget = limit
+    start = time.time()
+    try:
+      return runner(self._choosestepper(forward))
+    except steplimit:
+      self.limitreached = True
+      return True
+    finally:
+      self.budget = None
+      elapsed = time.time() - start
+      moved = abs(vm.trimmed + vm.statepos - startpos)
+      recorded = max(vm.trimmed + vm.statelen - startlen, 0)
+      self.livesteps += recorded
+      self.replaysteps += max(moved - recorded, 0)
+      self.lastrun = (moved, elapsed)
+
+  def stats(self):
+    vm = self.vm
+    steps, elapsed = self.lastrun
+    lo = hi = vm.pos
+    if vm.trimmedcells is not None:
+      lo = min(lo, vm.trimmedcells[0])
+      hi = max(hi, vm.trimmedcells[1])
+    for log in vm.backstate:
+      if log.pos is not None:
+        lo = min(lo, log.pos)
+        hi = max(hi, log.pos)
+    for log in vm.fwdstate:
+      if log.pos is not None:
+        lo = min(lo, log.pos)
+        hi = max(hi, log.pos)
+    return {
+      "steps": vm.statelen,
+      "totalsteps": vm.trimmed + vm.statelen,
+      "tracebytes": self._tracebytes(),
+      "lowcell": lo,
+      "highcell": hi,
+      "laststeps": steps,
+      "stepspersec": steps / elapsed if elapsed > 0 else None,
+      "livesteps": self.livesteps,
+      "replaysteps": self.replaysteps,
+    }
+
+# estimated from one recorded step: two bflog objects, their attribute dicts,
+# and a slot in each of the two lists
+  def _tracebytes(self):
+    vm = self.vm
+    lists = sys.getsizeof(vm.backstate) + sys.getsizeof(vm.fwdstate)
+    if not vm.fwdstate:
+      return lists
+    perstep = 0
+    for log in (vm.backstate[0], vm.fwdstate[0]):
+      perstep += sys.getsizeof(log) + sys.getsizeof(log.__dict__)
+    return lists + perstep * vm.statelen
+
+  def _runstep(self, stepper):
+    return stepper()
+
   def _runsteps(self, stepper):
-    unfinished = True
+    hang = self.hangcheck if stepper == self.safe_step else None
+    if hang is not None:
+      hang.start(self.vm)
     while True:
       unfinished = stepper()
       if not unfinished or self.isBreakpoint() or self.isWatchpoint():
         return unfinished
+      if hang is not None:
+        self.lasthang = hang.step()
+        if self.lasthang is not None:
+          return True
+
+# Within the recorded history, over, over2, out and nextline look up where
+# they'll stop in the flow index and jump there.  Each _...target method returns
+# (position, exact): exact means that's the destination, otherwise it's only
+# known that nothing before it is, so the normal loop carries on from there.
+# None means there's nothing to gain and the loop should just run.
+  def _jump(self, stepper, target):
+    self.index.sync(self.vm)
+    found = target(stepper == self.safe_step)
+    if found is None:
+      return None
+    pos, exact = found
+    if pos != self.vm.statepos:
+      self._seek(pos)
+    return True if exact else None
+
+  def _seek(self, pos):
+    vm = self.vm
+    forward = pos > vm.statepos
+    vm.seek(pos)
+    self.oldlinepos = vm.cmdat(pos - 1 if forward else pos + 1).pos.line
+    self.linepos = vm.getcmd().pos.line
+    self.loopstack = self._loopsof(vm.getcmd())
+
+  def _loopsof(self, cmd):
+    loops = []
+    if cmd is not self.vm.initcmd:
+      parent = cmd.parent
+      while parent is not None:
+        loops.append(parent)
+        parent = parent.parent
+      loops.reverse()
+    return loops
+
+# the step before the first time this loop's condition was checked, or as far
+# back as the history goes if that's been trimmed away
+  def _beforeloop(self, cond):
+    entry = self.index.lastentry(cond, self.vm.statepos)
+    return (0, False) if not entry else (entry - 1, True)
+
+# skip to the end of the index, but only if that's ahead
+  def _toend(self):
+    end = self.index.end()
+    return (end, False) if end > self.vm.statepos else None
+
+  def _outtarget(self, forward):
+    cond = self.vm.getcmd().parent
+    if not isinstance(cond, bf.bfcond):
+      return None
+    if not forward:
+      return self._beforeloop(cond)
+    leave = self.index.nextexit(cond, self.vm.statepos)
+    return (leave, True) if leave is not None else self._toend()
+
+  def _overtarget(self, forward):
+    vm, index = self.vm, self.index
+    cond, pos = vm.getcmd(), vm.statepos
+    if not isinstance(cond, bf.bfcond):
+      return None
+    if not forward:
+      if pos == 0:
+        return None
+      if vm.cmdat(pos - 1).parent is not cond:
+        return (pos - 1, True)
+      last = index.prevvisit(cond, pos)
+      return (0, False) if last is None else (last, True)
+    found = [x for x in (index.nextvisit(cond, pos), index.nextexit(cond, pos)) if x is not None]
+    return (min(found), True) if found else self._toend()
+
+  def _over2target(self, forward):
+    vm, index = self.vm, self.index
+    cond, pos = vm.getcmd(), vm.statepos
+    if not isinstance(cond, bf.bfcond):
+      return None
+    if not forward:
+      return self._beforeloop(cond)
+    leave = index.nextexit(cond, pos)
+    if leave is not None:
+      return (leave, True)
+# stay on a check of this loop's condition, where the over loop expects to be
+    last = index.prevvisit(cond, index.end() + 1)
+    return (last, False) if last is not None and last > pos else None
+
+  def _nextlinetarget(self, forward):
+    vm, index = self.vm, self.index
+    pos = vm.statepos
+    if vm.getcmd().pos.line != self.linepos:
+      return None
+    if not forward:
+      change = index.lastlinechange(pos)
+      return (0, False) if change is None else (change - 1, True)
+    change = index.nextlinechange(pos)
+    return (change, True) if change is not None else self._toend()
 
   def _runout(self, stepper):
     depth = len(self.loopstack)
@@ -115,6 +382,8 @@ class debughandler:
     if not self.loopstack:
       print("not currently in a loop")
       return True
+    if self._jump(stepper, self._outtarget):
+      return True
     while True:
       unfinished = stepper()
       if not unfinished or (len(self.loopstack) < depth and cmd != self.vm.getcmd()):
@@ -122,26 +391,144 @@ class debughandler:
 
   def _runover(self, stepper):
     depth = len(self.loopstack)
+    if self._jump(stepper, self._overtarget):
+      return True
+    return self._stepover(stepper, depth)
+
+  def _stepover(self, stepper, depth):
     while True:
       unfinished = stepper()
       if not unfinished or len(self.loopstack) <= depth:
         return unfinished
 
+# the index is only consulted once per command: when it can't give the exit,
+# the recording holds no later check of the condition, so the remaining passes
+# are stepped through without asking it again
   def _runover2(self, stepper):
-    depth = len(self.loopstack)
     cmd = self.vm.getcmd()
+    if self._jump(stepper, self._over2target):
+      return True
     while True:
-      unfinished = self._runover(stepper)
+      unfinished = self._stepover(stepper, len(self.loopstack))
       if not unfinished or cmd != self.vm.getcmd():
         return unfinished
 
+  def _rungoto(self, stepper, target):
+    if 0 <= target <= self.vm.statelen:
+      self._seek(target)
+      return True
+    while self.vm.statepos != target:
+      if not stepper():
+        return False
+    return True
+
   def _runnextline(self, stepper):
     curline = self.linepos
+    if self._jump(stepper, self._nextlinetarget):
+      return True
     while True:
       unfinished = stepper()
       if not unfinished or self.linepos != curline:
         return unfinished
-  
+
   def setinput(self, filename):
     self.vm.instream = open(filename, "rb")
 
+
+# A debugger paired with a rolling hash of its tape, kept current as it steps,
+# and a polynomial hash of every step taken so far: its command and the value
+# it read, wrote or moved the pointer to.  Two runs whose histories have parted
+# keep different keys even if their tapes come back together, so comparing keys
+# at any position says whether the runs have diverged by then.  The history
+# hash is undone on the way back by multiplying with the base's inverse.
+HISTORYBASE = 0x100000001b3
+HISTORYINVERSE = pow(HISTORYBASE, bf.HASHPRIME - 2, bf.HASHPRIME)
+
+def _stepvalue(log):
+  value = log.value if log.value is not None else log.pos if log.pos is not None else 0
+  return (log.cmd.pos.start * 0x9e3779b97f4a7c15 + value) % bf.HASHPRIME
+
+class hashedrun:
+  def __init__(self, debugger):
+    self.debugger = debugger
+    self.vm = debugger.vm
+    self.hash = bf.bfhash(self.vm.state)
+    self.history = 0
+    self.error = None
+
+  def key(self):
+    return (self.hash.value, self.history, self.vm.pos, self.vm.getcmd().pos.start)
+
+  def finished(self):
+    return self.vm.getcmd() is self.vm.endcmd
+
+# a step that raises, e.g. reading past the end of the input, leaves the vm
+# where it was and is remembered in 'error'
+  def step(self):
+    try:
+      if not self.debugger.safe_step():
+        return False
+    except Exception as e:
+      self.error = e
+      return False
+    vm = self.vm
+    new = vm.fwdstate[vm.statepos-1]
+    old = vm.backstate[vm.statepos-1].value
+    if old is not None:
+      self.hash.update(vm.pos, old, new.value)
+    self.history = (self.history * HISTORYBASE + _stepvalue(new)) % bf.HASHPRIME
+    return True
+
+  def rstep(self):
+    vm = self.vm
+    if vm.statepos > 0:
+      new = vm.fwdstate[vm.statepos-1]
+      old = vm.backstate[vm.statepos-1].value
+      if old is not None:
+        self.hash.update(vm.pos, new.value, old)
+      self.history = (self.history - _stepvalue(new)) * HISTORYINVERSE % bf.HASHPRIME
+    return self.debugger.safe_rstep()
+
+  def seek(self, statepos):
+    while self.vm.statepos < statepos and self.step(): pass
+    while self.vm.statepos > statepos and self.rstep(): pass
+
+# Run two debuggers in lock-step, comparing their keys every 'interval' steps.
+# Once a checkpoint differs, bisect between it and the last matching one; the
+# history hash makes that exact, since keys never match again once they've
+# differed.  Returns the number of steps after which the two runs still
+# agree but their next steps do not, leaving both debuggers positioned there, or
+# None if the runs finish (or hit 'limit') without diverging.  A step which
+# raises, such as a read past the end of the shorter input, ends the lock-step
+# there; if the runs still agree up to it, it's the divergence, unless both
+# runs fail at that step.
+def firstdivergence(a, b, interval=1024, limit=None):
+  runs = hashedrun(a), hashedrun(b)
+  same = 0
+  stepped = [True, True]
+  while True:
+    for i in range(interval):
+      if runs[0].finished() or runs[1].finished() or limit == runs[0].vm.statepos:
+        break
+      stepped = [run.step() for run in runs]
+      if not all(stepped):
+        for run, ok in zip(runs, stepped):
+          if ok: run.rstep()
+        break
+    if runs[0].key() != runs[1].key():
+      break
+    if not all(stepped):
+      return None if not any(stepped) else runs[0].vm.statepos
+    if runs[0].finished() or limit == runs[0].vm.statepos:
+      return None
+    same = runs[0].vm.statepos
+  differ = runs[0].vm.statepos
+  while differ - same > 1:
+    mid = (same + differ) // 2
+    for run in runs: run.seek(mid)
+    if runs[0].key() == runs[1].key():
+      same = mid
+    else:
+      differ = mid
+  for run in runs: run.seek(same)
+  return same
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+# JSON-RPC 2.0 front end for debughandler, for editor plugins and test harnesses.
+# Requests and responses are newline-delimited JSON objects, or arrays of them
+# for batches, e.g. a step, a memory range and the loop stack in one round-trip:
+#   [{"jsonrpc": "2.0", "id": 1, "method": "step"},
+#    {"jsonrpc": "2.0", "id": 2, "method": "mem", "params": [0, 63]},
+#    {"jsonrpc": "2.0", "id": 3, "method": "loopstack"}]
+# Requests are handled one at a time, so give run a step limit, e.g.
+#   {"jsonrpc": "2.0", "id": 4, "method": "run", "params": {"limit": 1000000}}
+# for programs which might not halt; "limited" in the result says it ran out.
+# Tape ranges come back base64-encoded rather than as one JSON number per cell.
+# Ranges of cells, as for mem, addwatch and watches, include both ends.
+# The program reads no input until the client gives it some with input or
+# setinput; until then a ',' fails with an error rather than waiting.
+
+from debugger import debughandler
+import bfdebug as bf
+import argparse
+import array
+import base64
+import inspect
+import io
+import json
+import os
+import socketserver
+import sys
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+class rpcerror(Exception):
+  def __init__(self, code, message):
+    Exception.__init__(self, message)
+    self.code = code
+    self.message = message
+
+# cells fit in a byte unless the program has over- or underflowed one, in
+# which case fall back to little-endian 32-bit ints
+def encodecells(cells):
+  try:
+    data = bytes(bytearray(cells))
+    encoding = "u8"
+  except ValueError:
+    packed = array.array("i", cells)
+    if sys.byteorder == "big":
+      packed.byteswap()
+    data = packed.tobytes()
+    encoding = "i32le"
+  return {"encoding": encoding, "data": base64.b64encode(data).decode("ascii")}
+
+def posinfo(cmd):
+  return {"line": cmd.pos.line, "start": cmd.pos.start, "end": cmd.pos.end, "cmd": repr(cmd)}
+
+class debugservice:
+  def __init__(self, debugger):
+    self.debugger = debugger
+    self.vm = debugger.vm
+    self.output = io.StringIO()
+    self.vm.outstream = self.output
+    self.vm.instream = io.BytesIO()
+    self.methods = {
+      "state": self.state,
+      "step": self.stepper("step"),
+      "over": self.stepper("over"),
+      "over2": self.stepper("over2"),
+      "out": self.stepper("out"),
+      "nextline": self.stepper("nextline"),
+      "run": self.stepper("run"),
+      "addbrk": self.addbrk,
+      "delbrk": self.delbrk,
+      "breakpoints": self.breakpoints,
+      "addwatch": self.addwatch,
+      "delwatch": self.delwatch,
+      "watches": self.watches,
+      "mem": self.mem,
+      "loopstack": self.loopstack,
+      "setinput": self.setinput,
+      "input": self.input,
+      "output": self.readoutput,
+      "stats": debugger.stats,
+      "hangcheck": self.hangcheck,
+    }
+
+  def stepper(self, name):
+    method = getattr(self.debugger, name)
+    def dostep(forward=True, limit=None):
+      unfinished = method(forward, limit)
+      return {
+        "unfinished": unfinished,
+        "limited": self.debugger.limitreached,
+        "breakpoint": self.debugger.isBreakpoint(),
+        "watchpoint": self.debugger.isWatchpoint(),
+        "hang": self.debugger.lasthang,
+        "state": self.state(),
+      }
+    return dostep
+
+  def hangcheck(self, enabled=None):
+    if enabled is not None:
+      self.debugger.sethangcheck(enabled)
+    return self.debugger.hangcheck is not None
+
+  def state(self):
+    vm = self.vm
+    info = posinfo(vm.getcmd())
+    info.update({
+      "pos": vm.pos,
+      "value": vm.state[vm.pos],
+      "statepos": vm.statepos,
+      "statelen": vm.statelen,
+      "step": vm.trimmed + vm.statepos,
+    })
+    return info
+
+  def addbrk(self, line):
+    ok, msg = self.debugger.addbrk(line)
+    return {"ok": ok, "message": msg}
+
+  def delbrk(self, line):
+    ok, msg = self.debugger.delbrk(line)
+    return {"ok": ok, "message": msg}
+
+  def breakpoints(self):
+    return sorted(self.debugger.breaklines)
+
+  def addwatch(self, name, pos=None, hi=None):
+    ok, msg = self.debugger.addwatch(name, self.vm.pos if pos is None else pos, hi)
+    return {"ok": ok, "message": msg}
+
+  def delwatch(self, name=None, pos=None):
+    if pos is not None:
+      ok, msg = self.debugger.delwatchbypos(pos)
+    elif name is not None:
+      ok, msg = self.debugger.delwatchbyname(name)
+    else:
+      raise rpcerror(INVALID_PARAMS, "delwatch needs a name or a pos")
+    return {"ok": ok, "message": msg}
+
+  def watches(self):
+    return [{"name": name, "lo": lo, "hi": hi} for lo, hi, name in self.debugger.watches]
+
+  def mem(self, lo=None, hi=None):
+    vm = self.vm
+    lo = vm.pos if lo is None else max(lo, 0)
+    hi = lo if hi is None else min(hi, len(vm.state) - 1)
+    result = encodecells(vm.state[lo:hi+1])
+    result.update({"lo": lo, "hi": max(lo - 1, hi)})
+    return result
+
+  def loopstack(self):
+    return [posinfo(cmd) for cmd in self.debugger.loopstack]
+
+  def setinput(self, filename):
+    self.debugger.setinput(filename)
+    return True
+
+  def input(self, data):
+    self.vm.instream = io.BytesIO(data.encode("latin-1"))
+    return True
+
+  def readoutput(self):
+    text = self.output.getvalue()
+    self.output.seek(0)
+    self.output.truncate()
+    return text
+
+  def call(self, request):
+    if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+      raise rpcerror(INVALID_REQUEST, "invalid request")
+    method = self.methods.get(request["method"])
+    if method is None:
+      raise rpcerror(METHOD_NOT_FOUND, "no such method '{}'".format(request["method"]))
+    params = request.get("params", [])
+    args, kwargs = (params, {}) if isinstance(params, list) else ([], params)
+    if not isinstance(kwargs, dict):
+      raise rpcerror(INVALID_PARAMS, "params must be an array or an object")
+# only a mismatch with the method's signature is the caller's fault; errors
+# from the method itself are reported as internal errors by respond()
+    try:
+      inspect.signature(method).bind(*args, **kwargs)
+    except TypeError as e:
+      raise rpcerror(INVALID_PARAMS, str(e))
+    return method(*args, **kwargs)
+
+  def respond(self, request):
+    reqid = request.get("id") if isinstance(request, dict) else None
+    try:
+      response = {"jsonrpc": "2.0", "id": reqid, "result": self.call(request)}
+    except rpcerror as e:
+      response = {"jsonrpc": "2.0", "id": reqid, "error": {"code": e.code, "message": e.message}}
+    except Exception as e:
+      response = {"jsonrpc": "2.0", "id": reqid, "error": {"code": INTERNAL_ERROR, "message": repr(e)}}
+    # requests without an id are notifications and get no response
+    if isinstance(request, dict) and "id" not in request:
+      return None
+    return response
+
+  # handle one line of input, returning one line of output or None
+  def handle(self, line):
+    try:
+      request = json.loads(line)
+    except ValueError as e:
+      response = {"jsonrpc": "2.0", "id": None, "error": {"code": PARSE_ERROR, "message": str(e)}}
+      return json.dumps(response)
+    if isinstance(request, list):
+      if not request:
+        response = {"jsonrpc": "2.0", "id": None, "error": {"code": INVALID_REQUEST, "message": "empty batch"}}
+        return json.dumps(response)
+      responses = [r for r in map(self.respond, request) if r is not None]
+      return json.dumps(responses) if responses else None
+    response = self.respond(request)
+    return None if response is None else json.dumps(response)
+
+class rpchandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    service = self.server.service
+    for line in iter(self.rfile.readline, b""):
+      line = line.strip()
+      if not line:
+        continue
+      reply = service.handle(line.decode("utf-8"))
+      if reply is not None:
+        self.wfile.write(reply.encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+class tcpserver(socketserver.TCPServer):
+  allow_reuse_address = True
+
+def makeserver(service, port=None, unixpath=None, host="127.0.0.1"):
+  if unixpath is not None:
+    if os.path.exists(unixpath):
+      os.unlink(unixpath)
+    server = socketserver.UnixStreamServer(unixpath, rpchandler)
+  else:
+    server = tcpserver((host, port), rpchandler)
+  server.service = service
+  return server
+
+def main():
+  parser = argparse.ArgumentParser(description="Serve a debugger session over JSON-RPC.")
+  parser.add_argument("script")
+  group = parser.add_mutually_exclusive_group()
+  group.add_argument("--unix", metavar="PATH", help="listen on a Unix socket")
+  group.add_argument("--port", type=int, default=7437, help="listen on localhost TCP (default %(default)s)")
+  args = parser.parse_args()
+  with open(args.script) as infile:
+    service = debugservice(debughandler(infile.read(), bf.defaultcachedir()))
+  server = makeserver(service, args.port, args.unix)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    if args.unix is not None:
+      os.unlink(args.unix)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,123 @@
+import array
+import bisect
+import bfdebug as bf
+
+# Index of control-flow events in a vm's recording: the steps at which the
+# current line changes, and for each loop the steps at which its condition is
+# checked, at which it is entered and at which it is left.  With these, over,
+# out and nextline can find their destination in the recorded history with a
+# binary search instead of walking every iteration of a loop.
+#
+# Positions are statepos values: position p is the state before the p'th
+# command runs, so its command is fwdstate[p].cmd, or newcmd at the end of the
+# recording.  The index is brought up to date lazily by sync(), so recording
+# costs nothing extra, and notices when the recording has been truncated or
+# trimmed by checking that the entries it saw are still the ones in fwdstate.
+class flowindex:
+  markevery = 4096
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.length = 0
+    self.tail = None
+    self.lastcmd = None
+    self.frontier = []
+    self.marks = []
+    self.linechanges = array.array("l")
+    self.visits = {}
+    self.entries = {}
+    self.exits = {}
+
+  def _events(self):
+    yield self.linechanges
+    for table in (self.visits, self.entries, self.exits):
+      for events in table.values():
+        yield events
+
+  def _cut(self, length):
+    for events in self._events():
+      del events[bisect.bisect_left(events, length):]
+    self.frontier = []
+
+  def _truncate(self, vm, length):
+    self._cut(length)
+    self.length = length
+    self.tail = vm.fwdstate[length-1]
+    self.lastcmd = self.tail.cmd
+    del self.marks[length // self.markevery:]
+
+# returns the event lists 'pos' was added to
+  def _add(self, pos, cmd, prev):
+    added = []
+    if prev is not None:
+      if cmd.pos.line != prev.pos.line:
+        added.append(self.linechanges)
+      if isinstance(prev, bf.bfcond) and cmd is not prev.subcmds[0]:
+        added.append(self.exits.setdefault(prev, array.array("l")))
+    if isinstance(cmd, bf.bfcond):
+      added.append(self.visits.setdefault(cmd, array.array("l")))
+      if prev is None or prev.parent is not cmd:
+        added.append(self.entries.setdefault(cmd, array.array("l")))
+    for events in added:
+      events.append(pos)
+    return added
+
+  def sync(self, vm):
+    fwd = vm.fwdstate
+# the frontier's events were guesses at what the next step would be; take
+# back just those, rather than sweeping every loop's lists
+    for events in self.frontier:
+      events.pop()
+    self.frontier = []
+    if self.length > vm.statelen or (self.length and fwd[self.length-1] is not self.tail):
+# find the last checkpoint that still matches and re-index from there
+      valid = 0
+      for index in range(min(len(self.marks), vm.statelen // self.markevery), 0, -1):
+        if fwd[index * self.markevery - 1] is self.marks[index-1]:
+          valid = index * self.markevery
+          break
+      if valid == 0:
+        self.reset()
+      else:
+        self._truncate(vm, valid)
+    prev = self.lastcmd
+    for pos in range(self.length, vm.statelen):
+      cmd = fwd[pos].cmd
+      self._add(pos, cmd, prev)
+      prev = cmd
+      if (pos + 1) % self.markevery == 0:
+        self.marks.append(fwd[pos])
+    if vm.statelen > self.length:
+      self.length = vm.statelen
+      self.tail = fwd[-1]
+      self.lastcmd = prev
+    self.frontier = self._add(self.length, vm.newcmd, prev)
+
+# the last indexed position: the end of the recording
+  def end(self):
+    return self.length
+
+  def nextvisit(self, cond, pos):
+    return _after(self.visits.get(cond), pos)
+  def prevvisit(self, cond, pos):
+    return _before(self.visits.get(cond), pos)
+  def nextexit(self, cond, pos):
+    return _after(self.exits.get(cond), pos)
+  def lastentry(self, cond, pos):
+    return _before(self.entries.get(cond), pos + 1)
+  def nextlinechange(self, pos):
+    return _after(self.linechanges, pos)
+  def lastlinechange(self, pos):
+    return _before(self.linechanges, pos + 1)
+
+def _after(events, pos):
+  if not events: return None
+  index = bisect.bisect_right(events, pos)
+  return events[index] if index < len(events) else None
+
+def _before(events, pos):
+  if not events: return None
+  index = bisect.bisect_left(events, pos)
+  return events[index-1] if index > 0 else None
@@ -0,0 +1,106 @@
+import bfdebug as bf
+
+# Detects provably infinite loops while running forward.  A rolling hash of the
+# tape is kept current from each step's single-cell change, and every time a
+# loop condition is checked the (hash, pointer) pair is compared against a
+# sample taken at an earlier check of the same condition.  Samples are moved
+# forward Brent-style, at checks 1, 2, 4, 8... after the last one, so any cycle
+# through a condition is found within a few of its periods, at O(1) per step.
+#
+# A matching hash only makes a repeat likely, so it's confirmed against the
+# recorded history: the pointer ends where it started, every cell written in
+# between is back to its old value, and no input was read.  Since the vm is
+# deterministic apart from input, the same state will then come round forever.
+class hangdetector:
+  def __init__(self):
+    self.vm = None
+    self.hash = None
+    self.samples = {}
+
+  def start(self, vm):
+    self.vm = vm
+    self.hash = bf.bfhash(vm.state)
+    self.samples = {}
+
+# call after each forward step; returns a report of the loop if the state
+# has provably been seen before, otherwise None
+  def step(self):
+    vm = self.vm
+    at = vm.statepos - 1
+    old = vm.backstate[at].value
+    if old is not None:
+      self.hash.update(vm.pos, old, vm.fwdstate[at].value)
+    cond = vm.getcmd()
+    if not isinstance(cond, bf.bfcond):
+      return None
+    key = (self.hash.value, vm.pos)
+    sample = self.samples.get(cond)
+    if sample is None:
+      self.samples[cond] = [key, vm.statepos, vm.fwdstate[at], 1, 0]
+      return None
+    if sample[0] == key:
+      report = self._verify(sample[1], sample[2])
+      if report is not None:
+        return report
+    sample[4] += 1
+    if sample[4] == sample[3]:
+      sample[:] = [key, vm.statepos, vm.fwdstate[at], sample[3] * 2, 0]
+    return None
+
+  def _verify(self, start, anchor):
+    vm = self.vm
+# the sample is useless if the history it points into has been trimmed
+    if start >= vm.statepos or vm.fwdstate[start-1] is not anchor:
+      return None
+    pos = vm.pos
+    firstvalues = {}
+    cmds = set()
+    for index in range(start, vm.statepos):
+      log = vm.fwdstate[index]
+      if isinstance(log.cmd, bf.bfread):
+        return None
+      cmds.add(log.cmd)
+      if log.pos is not None: pos = log.pos
+      if log.value is not None and pos not in firstvalues:
+        firstvalues[pos] = vm.backstate[index].value
+    if pos != vm.pos:
+      return None
+    for cell, value in firstvalues.items():
+      if vm.state[cell] != value:
+        return None
+    loop = innermostloop(vm.getcmd(), cmds)
+# a loop left unclosed at the end of the script ends with its last command
+    close = loop.closepos or loop.subcmds[-1].pos
+    return {
+      "line": loop.pos.line,
+      "column": column(vm.script, loop.pos.start),
+      "start": loop.pos.start,
+      "endline": close.line,
+      "endcolumn": column(vm.script, close.end - 1),
+      "end": close.end,
+      "since": vm.trimmed + start,
+      "period": vm.statepos - start,
+    }
+
+# offset of script[index] from the start of its line
+def column(script, index):
+  return index - (script.rfind("\n", 0, index) + 1)
+
+# the innermost loop whose span, condition included, holds every one of 'cmds'
+def innermostloop(cond, cmds):
+  loops = []
+  loop = cond
+  while isinstance(loop, bf.bfcond):
+    loops.append(loop)
+    loop = loop.parent
+  for cmd in cmds:
+    while len(loops) > 1 and not _inside(cmd, loops[0]):
+      loops.pop(0)
+  return loops[0]
+
+def _inside(cmd, loop):
+  while cmd is not None:
+    if cmd is loop:
+      return True
+    cmd = cmd.parent
+  return False
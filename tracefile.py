@@ -0,0 +1,101 @@
+# Binary execution traces, as written by the debugger's trace command.
+#
+# A trace file is an 8-byte magic string followed by fixed-width little-endian
+# records, one per executed step:
+#   step     u64  number of steps executed before this one, as for goto
+#   command  u32  index of the command in program order (see commandlist)
+#   pointer  i32  pointer position after the step
+#   old      i32  value of the cell under the pointer before the step
+#   new      i32  value of the cell under the pointer after the step
+# Steps which don't write to memory have old == new.
+
+import bfdebug as bf
+import mmap
+import struct
+
+MAGIC = b"BFTRACE1"
+RECORD = struct.Struct("<QIiii")
+
+# the numbering used for the command field: the vm's initial no-op, then every
+# command in program order, then the end of the program
+def commandlist(vm):
+  return [vm.initcmd] + bf.flatten(vm.allcmds) + [vm.endcmd]
+
+# Buffers records and writes them out in large chunks, closing the stream when
+# done if 'closestream' is set.
+class tracewriter:
+  def __init__(self, stream, vm, chunksize=1 << 20, closestream=True):
+    self.stream = stream
+    self.closestream = closestream
+    self.indexes = dict((cmd, i) for i, cmd in enumerate(commandlist(vm)))
+    self.step = vm.trimmed + vm.statelen
+    self.chunksize = chunksize
+    self.buffer = bytearray(MAGIC)
+
+  def record(self, cmd, pointer, old, new):
+    self.buffer += RECORD.pack(self.step, self.indexes[cmd], pointer, old, new)
+    self.step += 1
+    if len(self.buffer) >= self.chunksize:
+      self.flush()
+
+  def flush(self):
+    self.stream.write(self.buffer)
+    self.stream.flush()
+    del self.buffer[:]
+
+  def close(self):
+    self.flush()
+    if self.closestream:
+      self.stream.close()
+
+def _checkmagic(stream):
+  if stream.read(len(MAGIC)) != MAGIC:
+    raise ValueError("not a trace file")
+
+# generate (step, command, pointer, old, new) tuples from a trace file
+def records(path, chunkrecords=65536):
+  with open(path, "rb") as tracefile:
+    _checkmagic(tracefile)
+    while True:
+      chunk = tracefile.read(RECORD.size * chunkrecords)
+      whole = len(chunk) - len(chunk) % RECORD.size
+      for record in RECORD.iter_unpack(chunk[:whole]):
+        yield record
+      if len(chunk) < RECORD.size * chunkrecords:
+        return
+
+FIELDS = [("step", "<u8"), ("command", "<u4"), ("pointer", "<i4"), ("old", "<i4"), ("new", "<i4")]
+
+# Memory-mapped view of a trace file's records, indexed by record number.
+# Returns a numpy structured memmap when numpy is available, otherwise a
+# sequence of tuples decoded on access.  numpy is imported here rather than at
+# the top, since the debugger imports this module to write traces.
+def recordarray(path):
+  with open(path, "rb") as tracefile:
+    _checkmagic(tracefile)
+  try:
+    import numpy
+  except ImportError:
+    return mappedrecords(path)
+  return numpy.memmap(path, dtype=numpy.dtype(FIELDS), mode="r", offset=len(MAGIC))
+
+class mappedrecords:
+  def __init__(self, path):
+    with open(path, "rb") as tracefile:
+      self.map = mmap.mmap(tracefile.fileno(), 0, access=mmap.ACCESS_READ)
+    self.length = (len(self.map) - len(MAGIC)) // RECORD.size
+
+  def __len__(self):
+    return self.length
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in range(*index.indices(self.length))]
+    if index < 0:
+      index += self.length
+    if not 0 <= index < self.length:
+      raise IndexError(index)
+    return RECORD.unpack_from(self.map, len(MAGIC) + index * RECORD.size)
+
+  def close(self):
+    self.map.close()